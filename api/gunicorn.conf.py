@@ -0,0 +1,20 @@
+"""
+Gunicorn configuration for the L402 skill server.
+
+Runs ONE threaded worker: payment_store, its journal and the stats counters
+live in process memory, so several worker processes would each keep their
+own copy and overwrite each other's payments on disk. The app is I/O-bound
+(LNbits calls), so threads give the concurrency.
+"""
+
+bind = "0.0.0.0:8402"
+worker_class = "gthread"
+workers = 1
+threads = 16
+timeout = 30
+
+
+def post_worker_init(worker):
+    """Initialise server state inside the worker, after the app is loaded."""
+    from server import init_server
+    init_server()
@@ -16,24 +16,73 @@ License: All Rights Reserved
 """
 
 import os
+import re
 import json
 import time
 import hashlib
 import hmac
 import base64
 import secrets
-from pathlib import Path
+import dataclasses
+import decimal
+import uuid
+from datetime import date
+import signal
+from array import array
+import threading
+from concurrent.futures import Future, TimeoutError as FuturesTimeout
+from collections import OrderedDict
 from functools import wraps
+from operator import itemgetter
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, Response
 from flask_cors import CORS
+from werkzeug.http import http_date
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from skill_parser import parse_skill_content
 from trajectory_parser import load_trajectory, load_all_trajectories
 
+try:
+    import orjson  # Native serializer, several times faster than stdlib json
+except ImportError:
+    orjson = None
+
 app = Flask(__name__)
 CORS(app)
 
+def _json_default(o):
+    """Encode the extra types Flask's default JSON provider supports."""
+    if isinstance(o, date):
+        return http_date(o)
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return dataclasses.asdict(o)
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+if orjson is not None:
+    # Non-str keys like jsonify; dates and dataclasses go through _json_default
+    # so the output matches Flask's provider rather than orjson's native form
+    _ORJSON_OPTIONS = (
+        orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+    )
+
+def _dumps(data) -> bytes:
+    """Serialize to UTF-8 JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(data, default=_json_default, option=_ORJSON_OPTIONS)
+    return json.dumps(data, ensure_ascii=False, default=_json_default).encode("utf-8")
+
+def ojsonify(data, status: int = 200) -> Response:
+    """Drop-in for flask.jsonify backed by _dumps."""
+    return Response(_dumps(data), status=status, mimetype="application/json")
+
 # =============================================================================
 # Configuration
 # =============================================================================
@@ -43,6 +92,7 @@ LNBITS_API_KEY = os.environ.get("LNBITS_API_KEY", "")  # Invoice/read key
 LNBITS_ADMIN_KEY = os.environ.get("LNBITS_ADMIN_KEY", "")  # Admin key for creating invoices
 SKILLS_DIR = os.environ.get("SKILLS_DIR", "/app/skills")
 SERVER_SECRET = os.environ.get("SERVER_SECRET", secrets.token_hex(32))
+_SERVER_SECRET_B = SERVER_SECRET.encode()  # HMAC key, encoded once
 PORT = int(os.environ.get("PORT", 8402))
 MOCK_MODE = os.environ.get("MOCK_MODE", "false").lower() == "true"  # For testing without LNbits
 
@@ -87,39 +137,225 @@ TRAJECTORY_REGISTRY = {
 # Payment token management (in-memory + file persistence)
 # =============================================================================
 
-# Stores: {payment_hash: {"skill_id": str, "paid": bool, "created": float, "preimage": str}}
-payment_store = {}
+class PaymentTable:
+    """
+    Column-oriented payment store: one contiguous array per field instead of
+    a dict per payment, addressed by payment hash through an index.
+    
+    Rows are only appended or updated in place; expiry builds a new table
+    (see pruned()) so concurrent readers never see a half-compacted one.
+    """
+    
+    def __init__(self, entries: dict = None):
+        self._index = {}  # {payment_hash: row}
+        self._hashes = []
+        self._skill = []
+        self._created = array("d")
+        self._amount = array("I")
+        self._paid = bytearray()
+        for payment_hash, entry in (entries or {}).items():
+            self.put(payment_hash, entry)
+    
+    def __len__(self) -> int:
+        return len(self._hashes)
+    
+    def __contains__(self, payment_hash: str) -> bool:
+        return payment_hash in self._index
+    
+    def _entry(self, row: int) -> dict:
+        return {
+            "skill_id": self._skill[row],
+            "paid": bool(self._paid[row]),
+            "created": self._created[row],
+            "amount": self._amount[row],
+        }
+    
+    def get(self, payment_hash: str, default=None) -> dict:
+        """Return the payment as a dict (a copy), or default if unknown."""
+        row = self._index.get(payment_hash)
+        return default if row is None else self._entry(row)
+    
+    def put(self, payment_hash: str, entry: dict):
+        """Insert or update a payment from its dict form (ValueError if malformed)."""
+        # Validate every field before touching a column so a bad row never
+        # leaves the columns misaligned
+        skill_id = entry.get("skill_id")
+        created = float(entry.get("created") or 0)
+        amount = int(entry.get("amount") or 0)
+        if not 0 <= amount <= 0xFFFFFFFF:
+            raise ValueError(f"amount out of range: {amount}")
+        paid = 1 if entry.get("paid") else 0
+        
+        row = self._index.get(payment_hash)
+        if row is None:
+            self._hashes.append(payment_hash)
+            self._skill.append(skill_id)
+            self._created.append(created)
+            self._amount.append(amount)
+            self._paid.append(paid)
+            # Publish the row only once every column holds it
+            self._index[payment_hash] = len(self._hashes) - 1
+        else:
+            self._skill[row] = skill_id
+            self._created[row] = created
+            self._amount[row] = amount
+            self._paid[row] = paid
+    
+    def pruned(self, cutoff: float) -> "PaymentTable":
+        """Return a table without payments created before cutoff (self if none)."""
+        keep = [row for row, created in enumerate(self._created) if created >= cutoff]
+        if len(keep) == len(self._hashes):
+            return self
+        table = PaymentTable()
+        table._hashes = [self._hashes[row] for row in keep]
+        table._skill = [self._skill[row] for row in keep]
+        table._created = array("d", (self._created[row] for row in keep))
+        table._amount = array("I", (self._amount[row] for row in keep))
+        table._paid = bytearray(self._paid[row] for row in keep)
+        table._index = {h: row for row, h in enumerate(table._hashes)}
+        return table
+    
+    def paid_totals(self) -> tuple:
+        """Return (number of paid payments, total sats paid)."""
+        count = sats = 0
+        for paid, amount in zip(self._paid, self._amount):
+            if paid:
+                count += 1
+                sats += amount
+        return count, sats
+    
+    def to_dict(self) -> dict:
+        """Dict form used for the JSON snapshot."""
+        return {h: self._entry(row) for row, h in enumerate(self._hashes)}
+
+# PaymentTable keyed by payment_hash; get() yields
+# {"skill_id": str, "paid": bool, "created": float, "amount": int}.
+# Persisted as a JSON snapshot of that dict form plus an append-only journal
+# (one JSON line per mutation); save_payments() compacts the journal back
+# into the snapshot.
+payment_store = PaymentTable()
 PAYMENT_STORE_FILE = "/app/data/payments.json"
+PAYMENT_LOG_FILE = PAYMENT_STORE_FILE + ".log"
+# Serialises payment_store mutations and file writes across server threads.
+# In-process only: the server must run as a single (threaded) process.
+_PAYMENT_LOCK = threading.RLock()
 
 def load_payments():
-    """Load payment store from disk."""
+    """Load payment store from disk: snapshot first, then replay the journal."""
     global payment_store
+    store = {}
     try:
         if os.path.exists(PAYMENT_STORE_FILE):
             with open(PAYMENT_STORE_FILE, "r") as f:
-                payment_store = json.load(f)
+                store = json.load(f)
+        if not isinstance(store, dict):
+            store = {}
+    except Exception:
+        store = {}
+    try:
+        if os.path.exists(PAYMENT_LOG_FILE):
+            with open(PAYMENT_LOG_FILE, "r") as f:
+                for line in f:
+                    try:
+                        store.update(json.loads(line))
+                    except (ValueError, TypeError):
+                        continue  # Torn last line after a crash
     except Exception:
-        payment_store = {}
+        pass
+    
+    # A corrupt row is dropped, never fatal: the store is only a 24h cache
+    table = PaymentTable()
+    for payment_hash, entry in store.items():
+        try:
+            table.put(payment_hash, entry)
+        except Exception:
+            continue
+    with _PAYMENT_LOCK:
+        payment_store = table
+
+def record_payment(payment_hash: str, entry: dict):
+    """Store a payment and append it to the journal (O(1) disk write)."""
+    line = _dumps({payment_hash: entry}) + b"\n"
+    with _PAYMENT_LOCK:
+        payment_store.put(payment_hash, entry)
+        os.makedirs(os.path.dirname(PAYMENT_LOG_FILE), exist_ok=True)
+        with open(PAYMENT_LOG_FILE, "ab") as f:
+            f.write(line)
 
 def save_payments():
-    """Persist payment store to disk."""
-    os.makedirs(os.path.dirname(PAYMENT_STORE_FILE), exist_ok=True)
-    with open(PAYMENT_STORE_FILE, "w") as f:
-        json.dump(payment_store, f)
+    """Persist the full payment store as a snapshot and truncate the journal."""
+    with _PAYMENT_LOCK:
+        os.makedirs(os.path.dirname(PAYMENT_STORE_FILE), exist_ok=True)
+        tmp_file = PAYMENT_STORE_FILE + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(_dumps(payment_store.to_dict()))
+        os.replace(tmp_file, PAYMENT_STORE_FILE)
+        open(PAYMENT_LOG_FILE, "w").close()
 
 def cleanup_expired_payments():
-    """Remove payments older than 24 hours."""
-    now = time.time()
-    expired = [h for h, p in payment_store.items() if now - p.get("created", 0) > 86400]
-    for h in expired:
-        del payment_store[h]
-    if expired:
-        save_payments()
+    """Remove payments older than 24 hours (single pass over the created column)."""
+    global payment_store
+    cutoff = time.time() - 86400
+    with _PAYMENT_LOCK:
+        kept = payment_store.pruned(cutoff)
+        if kept is not payment_store:
+            payment_store = kept
+            save_payments()
+
+# Running 24h totals served by /api/stats: bumped when a payment is confirmed
+# and recomputed from payment_store by every background sweep.
+_stats = {"paid": 0, "sats": 0}
+SWEEP_INTERVAL = 300  # seconds
+
+def _recount_stats():
+    """Recompute the paid totals from payment_store."""
+    with _PAYMENT_LOCK:
+        _stats["paid"], _stats["sats"] = payment_store.paid_totals()
+
+def mark_paid(payment_hash: str):
+    """
+    Record a confirmed payment once and count it towards the stats.
+    Never raises: this is bookkeeping on the auth and status paths, so a
+    failed journal write is logged and the in-memory state still updated.
+    """
+    with _PAYMENT_LOCK:
+        entry = payment_store.get(payment_hash)
+        if entry is None or entry.get("paid"):
+            return
+        try:
+            record_payment(payment_hash, {**entry, "paid": True})
+        except Exception as e:
+            payment_store.put(payment_hash, {**entry, "paid": True})
+            app.logger.error(f"Could not persist paid state for {payment_hash}: {e}")
+        _stats["paid"] += 1
+        _stats["sats"] += entry.get("amount", 0)
+
+def _bg_sweep():
+    """Expire old payments and refresh stats, then reschedule itself."""
+    try:
+        cleanup_expired_payments()
+        _recount_stats()
+    except Exception as e:
+        app.logger.error(f"Payment sweep failed: {e}")
+    timer = threading.Timer(SWEEP_INTERVAL, _bg_sweep)
+    timer.daemon = True
+    timer.start()
 
 # =============================================================================
 # LNbits API integration
 # =============================================================================
 
+# Shared session: keeps TCP/TLS connections to LNbits alive across requests.
+# Read retries only apply to idempotent methods (GET), so invoices are never duplicated.
+_LN_SESSION = requests.Session()
+_LN_ADAPTER = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1),
+)
+_LN_SESSION.mount("http://", _LN_ADAPTER)
+_LN_SESSION.mount("https://", _LN_ADAPTER)
+
 def create_invoice(amount_sats: int, memo: str) -> dict:
     """Create a Lightning invoice via LNbits API (or mock for testing)."""
     
@@ -147,7 +383,7 @@ def create_invoice(amount_sats: int, memo: str) -> dict:
     }
     
     try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=10)
+        resp = _LN_SESSION.post(url, json=payload, headers=headers, timeout=10)
         resp.raise_for_status()
         data = resp.json()
         return {
@@ -159,39 +395,196 @@ def create_invoice(amount_sats: int, memo: str) -> dict:
         app.logger.error(f"LNbits invoice creation failed: {e}")
         return None
 
-def check_invoice_paid(payment_hash: str) -> bool:
-    """Check if a Lightning invoice has been paid via LNbits API."""
-    
-    if MOCK_MODE:
-        return payment_store.get(payment_hash, {}).get("paid", False)
-    
+# Short-lived cache of LNbits payment status: {payment_hash: (paid, expires_at)}.
+# Unpaid results expire quickly so polling still sees the payment land; paid is
+# monotonic and kept for the token lifetime. Bounded: the least recently
+# stored entries are evicted beyond PAID_CACHE_MAX.
+_PAID_CACHE = OrderedDict()
+_PAID_CACHE_LOCK = threading.Lock()
+PAID_CACHE_MAX = 4096
+UNPAID_TTL = 2
+PAID_TTL = 86400
+
+def _cache_paid_status(payment_hash: str, paid: bool):
+    """Remember a payment status result, evicting the oldest entries when full."""
+    expires_at = time.time() + (PAID_TTL if paid else UNPAID_TTL)
+    with _PAID_CACHE_LOCK:
+        _PAID_CACHE[payment_hash] = (paid, expires_at)
+        _PAID_CACHE.move_to_end(payment_hash)
+        while len(_PAID_CACHE) > PAID_CACHE_MAX:
+            _PAID_CACHE.popitem(last=False)
+
+def _fetch_invoice_paid(payment_hash: str) -> bool:
+    """Look up a single invoice in LNbits. Returns None if LNbits could not answer."""
     url = f"{LNBITS_URL}/api/v1/payments/{payment_hash}"
     headers = {"X-Api-Key": LNBITS_API_KEY}
     
     try:
-        resp = requests.get(url, headers=headers, timeout=10)
+        resp = _LN_SESSION.get(url, headers=headers, timeout=10)
         resp.raise_for_status()
         data = resp.json()
         return data.get("paid", False)
     except Exception as e:
         app.logger.error(f"LNbits payment check failed: {e}")
+        return None
+
+def _listing_paid(payment: dict) -> bool:
+    """Paid flag of an entry in the LNbits payments listing."""
+    if "status" in payment:
+        return payment["status"] == "success"
+    return not payment.get("pending", True)
+
+class PaymentPoller:
+    """
+    Coalesces concurrent payment status checks.
+    
+    While no other lookup is in flight a check goes straight to LNbits. Checks
+    arriving meanwhile are queued; every `window` seconds one listing request
+    answers the whole queue. Only checks marked batchable (invoices recent
+    enough to be in the listing) are queued; the rest, and hashes missing from
+    the listing, use a per-invoice lookup in the caller's thread.
+    """
+    
+    def __init__(self, window: float = 0.2, listing_limit: int = 100, timeout: float = 15):
+        self.window = window
+        self.listing_limit = listing_limit
+        self.timeout = timeout
+        self._pending = {}  # {payment_hash: [Future, ...]}
+        self._direct = 0  # Per-invoice lookups currently in flight
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+    
+    def check(self, payment_hash: str, batchable: bool = True) -> bool:
+        """Return the paid status of an invoice, or None if LNbits could not answer."""
+        with self._lock:
+            batched = batchable and self._direct > 0
+            if batched:
+                future = Future()
+                self._pending.setdefault(payment_hash, []).append(future)
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+            else:
+                self._direct += 1
+        
+        if not batched:
+            try:
+                return _fetch_invoice_paid(payment_hash)
+            finally:
+                with self._lock:
+                    self._direct -= 1
+        
+        self._wake.set()
+        try:
+            paid = future.result(timeout=self.timeout)
+        except FuturesTimeout:
+            paid = None
+        if paid is None:
+            paid = _fetch_invoice_paid(payment_hash)
+        return paid
+    
+    def _run(self):
+        """Batch loop: wait for queued checks, then answer them with one listing."""
+        while True:
+            self._wake.wait()
+            time.sleep(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._wake.clear()
+            if not batch:
+                continue
+            
+            results = self._fetch_listing(batch.keys())
+            for payment_hash, futures in batch.items():
+                for future in futures:
+                    future.set_result(results.get(payment_hash))
+    
+    def _fetch_listing(self, hashes) -> dict:
+        """Paid status of the given hashes found among the recent LNbits payments."""
+        url = f"{LNBITS_URL}/api/v1/payments"
+        headers = {"X-Api-Key": LNBITS_API_KEY}
+        wanted = set(hashes)
+        
+        try:
+            resp = _LN_SESSION.get(url, params={"limit": self.listing_limit}, headers=headers, timeout=10)
+            resp.raise_for_status()
+            return {
+                p["payment_hash"]: _listing_paid(p)
+                for p in resp.json()
+                if p.get("payment_hash") in wanted
+            }
+        except Exception as e:
+            app.logger.error(f"LNbits payment listing failed: {e}")
+            return {}
+
+_POLLER = PaymentPoller()
+# Invoices issued longer ago than this are unlikely to be among the last
+# `listing_limit` LNbits payments, so batching them would only add latency
+BATCH_MAX_AGE = 600  # seconds
+
+def check_invoice_paid(payment_hash: str) -> bool:
+    """Check if a Lightning invoice has been paid via LNbits API."""
+    
+    if MOCK_MODE:
+        return payment_store.get(payment_hash, {}).get("paid", False)
+    
+    cached = _PAID_CACHE.get(payment_hash)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    
+    entry = payment_store.get(payment_hash)
+    recent = entry is not None and time.time() - entry["created"] < BATCH_MAX_AGE
+    paid = _POLLER.check(payment_hash, batchable=recent)
+    if paid is None:
         return False
+    
+    _cache_paid_status(payment_hash, paid)
+    return paid
 
 # =============================================================================
 # Macaroon-like token generation (simplified L402)
 # =============================================================================
 
+# Keyed once; copying the prepared HMAC skips re-deriving the key pads per call
+_HMAC_TEMPLATE = hmac.new(_SERVER_SECRET_B, b"", hashlib.sha256)
+
+def _mac(payload: bytes) -> bytes:
+    """HMAC-SHA256 of payload under SERVER_SECRET."""
+    h = _HMAC_TEMPLATE.copy()
+    h.update(payload)
+    return h.digest()
+
+MAC_TAG_LEN = 32  # Raw HMAC-SHA256 tag appended to the macaroon payload
+_HEX_RE = re.compile(r"[0-9a-fA-F]{64}")  # 32-byte Lightning preimage
+
 def create_macaroon(payment_hash: str, skill_id: str) -> str:
-    """Create a simple macaroon token binding payment_hash to skill_id."""
-    payload = f"{payment_hash}:{skill_id}:{int(time.time())}"
-    signature = hmac.new(
-        SERVER_SECRET.encode(), 
-        payload.encode(), 
-        hashlib.sha256
-    ).hexdigest()
-    token = base64.urlsafe_b64encode(f"{payload}:{signature}".encode()).decode()
+    """
+    Create a simple macaroon token binding payment_hash to skill_id.
+    Token: base64url("{payment_hash}:{skill_id}:{timestamp}" || 32-byte HMAC tag)
+    """
+    payload = f"{payment_hash}:{skill_id}:{int(time.time())}".encode()
+    token = base64.urlsafe_b64encode(payload + _mac(payload)).decode()
     return token
 
+def _legacy_macaroon_payload(macaroon_data: bytes) -> bytes:
+    """
+    Verify a macaroon in the previous format, ASCII "{hash}:{skill}:{ts}:{hexsig}".
+    Returns the signed payload, or None if the token is not a valid legacy one.
+    Tokens live 24 hours, so this can go once the last legacy token has expired.
+    """
+    try:
+        payload, sep, signature = macaroon_data.decode("ascii").rpartition(":")
+        signature_bytes = bytes.fromhex(signature)
+    except ValueError:
+        return None
+    if not sep or payload.count(":") != 2:
+        return None
+    payload = payload.encode()
+    if not hmac.compare_digest(_mac(payload), signature_bytes):
+        return None
+    return payload
+
 def verify_l402_auth(auth_header: str) -> dict:
     """
     Verify an L402 Authorization header.
@@ -201,36 +594,39 @@ def verify_l402_auth(auth_header: str) -> dict:
     if not auth_header or not auth_header.startswith("L402 "):
         return {"valid": False, "error": "Missing L402 authorization"}
     
-    token_part = auth_header[5:]  # Remove "L402 " prefix
+    # Split "L402 " prefix off, then macaroon:preimage in one scan
+    macaroon_b64, sep, preimage = auth_header[5:].partition(":")
+    if not sep:
+        return {"valid": False, "error": "Invalid L402 format"}
+    
+    # Reject malformed preimages before any base64 or HMAC work
+    if len(preimage) != 64 or not _HEX_RE.fullmatch(preimage):
+        return {"valid": False, "error": "Invalid preimage"}
     
     try:
-        # Split macaroon:preimage
-        parts = token_part.split(":")
-        if len(parts) < 2:
-            return {"valid": False, "error": "Invalid L402 format"}
-        
-        macaroon_b64 = parts[0]
-        preimage = parts[1]
+        # Decode macaroon and split off the fixed-size tag
+        macaroon_data = base64.urlsafe_b64decode(macaroon_b64)
         
-        # Decode macaroon
-        macaroon_data = base64.urlsafe_b64decode(macaroon_b64).decode()
-        mac_parts = macaroon_data.split(":")
+        # Verify signature (constant time) before trusting the payload
+        payload = None
+        if len(macaroon_data) > MAC_TAG_LEN:
+            candidate, tag = macaroon_data[:-MAC_TAG_LEN], macaroon_data[-MAC_TAG_LEN:]
+            if hmac.compare_digest(_mac(candidate), tag):
+                payload = candidate
+        if payload is None:
+            payload = _legacy_macaroon_payload(macaroon_data)
+        if payload is None:
+            return {"valid": False, "error": "Invalid macaroon signature"}
         
-        if len(mac_parts) != 4:
+        mac_parts = payload.decode().split(":")
+        if len(mac_parts) != 3:
             return {"valid": False, "error": "Invalid macaroon structure"}
         
-        payment_hash, skill_id, timestamp, signature = mac_parts
-        
-        # Verify signature
-        payload = f"{payment_hash}:{skill_id}:{timestamp}"
-        expected_sig = hmac.new(
-            SERVER_SECRET.encode(),
-            payload.encode(),
-            hashlib.sha256
-        ).hexdigest()
+        payment_hash, skill_id, timestamp = mac_parts
         
-        if not hmac.compare_digest(signature, expected_sig):
-            return {"valid": False, "error": "Invalid macaroon signature"}
+        # Check expiry (24 hours) before any preimage or LNbits work
+        if time.time() - int(timestamp) > 86400:
+            return {"valid": False, "error": "Token expired"}
         
         # Verify preimage matches payment_hash
         preimage_bytes = bytes.fromhex(preimage)
@@ -241,62 +637,173 @@ def verify_l402_auth(auth_header: str) -> dict:
             if not check_invoice_paid(payment_hash):
                 return {"valid": False, "error": "Payment not verified"}
         
-        # Check expiry (24 hours)
-        if time.time() - int(timestamp) > 86400:
-            return {"valid": False, "error": "Token expired"}
-        
-        return {"valid": True, "skill_id": skill_id, "payment_hash": payment_hash}
-        
     except Exception as e:
         return {"valid": False, "error": f"Verification failed: {str(e)}"}
+    
+    # Bookkeeping only, outside the try: it must never turn a valid token into a 401
+    mark_paid(payment_hash)
+    return {"valid": True, "skill_id": skill_id, "payment_hash": payment_hash}
 
 # =============================================================================
 # Skill content loader
 # =============================================================================
 
+# Preloaded at boot: skill markdown, parsed skills and structured trajectories.
+# The corpus is small and fixed per deploy, so requests are served from RAM.
+SKILL_BLOB = {}
+SKILL_PARSED = {}
+SKILL_PREVIEW = {}
+SKILL_ROUTING = {}
+TRAJ_BLOB = {}
+
+# Subset of the parsed skill exposed as "routing" in the default response format
+ROUTING_KEYS = ("trigger_conditions", "prerequisites", "next_steps", "contraindications")
+_pick_routing = itemgetter(*ROUTING_KEYS)
+
+# Absolute skill file paths, resolved once instead of per read
+_FILE_PATHS = {
+    skill_id: os.path.join(SKILLS_DIR, meta["file"])
+    for skill_id, meta in SKILL_REGISTRY.items()
+}
+
+def _read_file(path: str) -> str:
+    """Read a skill file from disk with a single open/read."""
+    with open(path, "rb") as f:
+        return f.read().decode("utf-8")
+
 def load_skill_content(skill_id: str) -> str:
-    """Load skill content from markdown file."""
+    """Load skill content from the preloaded blob, falling back to disk."""
     if skill_id not in SKILL_REGISTRY:
         return None
     
-    filepath = Path(SKILLS_DIR) / SKILL_REGISTRY[skill_id]["file"]
+    content = SKILL_BLOB.get(skill_id)
+    if content is not None:
+        return content
+    
+    filepath = _FILE_PATHS[skill_id]
     try:
-        return filepath.read_text(encoding="utf-8")
+        content = _read_file(filepath)
     except FileNotFoundError:
         app.logger.error(f"Skill file not found: {filepath}")
         return None
+    SKILL_BLOB[skill_id] = content
+    return content
+
+def _parsed_skill(skill_id: str) -> dict:
+    """Return the parsed structure of a skill, parsing at most once."""
+    structured = SKILL_PARSED.get(skill_id)
+    if structured is not None:
+        return structured
+    
+    content = load_skill_content(skill_id)
+    if not content:
+        return None
+    structured = parse_skill_content(content, skill_id)
+    SKILL_PARSED[skill_id] = structured
+    return structured
+
+def _build_routing(structured: dict) -> dict:
+    """Pick the ROUTING_KEYS subset out of a parsed skill."""
+    return dict(zip(ROUTING_KEYS, _pick_routing(structured)))
+
+def _skill_routing(skill_id: str) -> dict:
+    """Return the routing subset of a parsed skill, building it at most once."""
+    routing = SKILL_ROUTING.get(skill_id)
+    if routing is not None:
+        return routing
+    
+    structured = _parsed_skill(skill_id)
+    if structured is None:
+        return None
+    routing = SKILL_ROUTING[skill_id] = _build_routing(structured)
+    return routing
+
+def _extract_preview(content: str) -> str:
+    """Return the content up to (not including) the second ## heading."""
+    first = 0 if content.startswith("## ") else content.find("\n## ")
+    if first == -1:
+        return content
+    second = content.find("\n## ", first + 1)
+    return content if second == -1 else content[:second]
+
+def _build_preview(skill_id: str, content: str) -> str:
+    """Preview text for a skill: first section plus the paywall footer."""
+    price = SKILL_REGISTRY[skill_id]["price"]
+    return (
+        _extract_preview(content)
+        + f"\n\n---\n*[Preview only. Full content: {price} sats via L402 at /api/skills/{skill_id}]*"
+    )
+
+def preload_content():
+    """Read every skill and trajectory into memory in one pass."""
+    global SKILL_BLOB, SKILL_PARSED, SKILL_PREVIEW, SKILL_ROUTING, TRAJ_BLOB
+    
+    skills, parsed, previews, routing, trajectories = {}, {}, {}, {}, {}
+    # One bad file is logged and skipped; requests for it fall back to disk
+    for skill_id, filepath in _FILE_PATHS.items():
+        try:
+            content = _read_file(filepath)
+            structured = parse_skill_content(content, skill_id)
+            preview = _build_preview(skill_id, content)
+            skill_routing = _build_routing(structured)
+        except FileNotFoundError:
+            app.logger.error(f"Skill file not found: {filepath}")
+            continue
+        except Exception as e:
+            app.logger.error(f"Skill preload failed for {skill_id}: {e}")
+            continue
+        skills[skill_id] = content
+        parsed[skill_id] = structured
+        previews[skill_id] = preview
+        routing[skill_id] = skill_routing
+    
+    for traj_id in TRAJECTORY_REGISTRY:
+        try:
+            result = load_trajectory(traj_id)
+        except Exception as e:
+            app.logger.error(f"Trajectory preload failed for {traj_id}: {e}")
+            continue
+        if result:
+            trajectories[traj_id] = result
+    
+    # Swap whole dicts so a reload never exposes a half-filled cache
+    SKILL_BLOB, SKILL_PARSED, SKILL_PREVIEW, SKILL_ROUTING, TRAJ_BLOB = (
+        skills, parsed, previews, routing, trajectories
+    )
+
+def _reload_on_sighup(signum, frame):
+    """SIGHUP handler: re-read skill and trajectory files after a content update."""
+    try:
+        preload_content()
+    except Exception as e:
+        # Never let a failed reload propagate into the serving thread
+        app.logger.error(f"Content reload failed: {e}")
 
 # =============================================================================
 # API Routes
 # =============================================================================
 
-@app.route("/", methods=["GET"])
-def index():
-    """Server info and API documentation."""
-    return jsonify({
-        "name": "Overcome Stress — AI-Agent Skill Server",
-        "version": "1.0.0",
-        "author": "Sieto Reitsma, BSc OT | Official ReAttach Trainer",
-        "protocol": "L402",
-        "payment": "Lightning Network (sats)",
-        "endpoints": {
-            "GET /api/catalog": "Browse available skills (free)",
-            "GET /api/skills/{id}": "Request skill content (L402 paywall)",
-            "GET /api/skills/{id}/preview": "Free preview of skill (free)",
-            "GET /api/trajectories/{id}": "Request trajectory routing (L402 paywall)",
-            "GET /api/payment/{hash}/status": "Check payment status",
-        },
-        "total_skills": len(SKILL_REGISTRY),
-        "total_trajectories": len(TRAJECTORY_REGISTRY),
-    })
+# Discovery payloads are static for the process lifetime: serialize them once.
+_INDEX_BYTES = _dumps({
+    "name": "Overcome Stress — AI-Agent Skill Server",
+    "version": "1.0.0",
+    "author": "Sieto Reitsma, BSc OT | Official ReAttach Trainer",
+    "protocol": "L402",
+    "payment": "Lightning Network (sats)",
+    "endpoints": {
+        "GET /api/catalog": "Browse available skills (free)",
+        "GET /api/skills/{id}": "Request skill content (L402 paywall)",
+        "GET /api/skills/{id}/preview": "Free preview of skill (free)",
+        "GET /api/trajectories/{id}": "Request trajectory routing (L402 paywall)",
+        "GET /api/payment/{hash}/status": "Check payment status",
+    },
+    "total_skills": len(SKILL_REGISTRY),
+    "total_trajectories": len(TRAJECTORY_REGISTRY),
+})
 
 
-@app.route("/api/catalog", methods=["GET"])
-def catalog():
-    """
-    Free endpoint: returns the full skill catalog with metadata, pricing,
-    and routing info. This is what AI agents use to discover available skills.
-    """
+def _build_catalog() -> dict:
+    """Build the skill catalog from the registries."""
     skills = []
     for skill_id, meta in SKILL_REGISTRY.items():
         skills.append({
@@ -318,7 +825,7 @@ def catalog():
             "endpoint": f"/api/trajectories/{traj_id}",
         })
     
-    return jsonify({
+    return {
         "catalog": "Overcome Stress. Step by Step.",
         "author": "Sieto Reitsma",
         "methodology": "Corpus Systemics® | ReAttach Therapy",
@@ -326,7 +833,58 @@ def catalog():
         "trajectories": trajectories,
         "total_sats_full_program": 1025,
         "payment_protocol": "L402 via Lightning Network",
-    })
+    }
+
+
+_CATALOG_BYTES = _dumps(_build_catalog())
+
+# Invoice memos and the static part of each 402 body; handlers only merge in
+# the per-invoice fields.
+SKILL_MEMO = {
+    skill_id: f"Overcome Stress Skill: {skill_id} - {meta['title']}"
+    for skill_id, meta in SKILL_REGISTRY.items()
+}
+SKILL_402_BASE = {
+    skill_id: {
+        "status": 402, "message": "Payment required",
+        "skill": {"id": skill_id, "title": meta["title"], "price_sats": meta["price"], "type": meta["type"]},
+        "instructions": "Pay the Lightning invoice, then retry with header: Authorization: L402 {macaroon}:{preimage}",
+        "formats_available": ["full", "structured", "raw"],
+    }
+    for skill_id, meta in SKILL_REGISTRY.items()
+}
+
+TRAJ_MEMO = {
+    traj_id: f"Overcome Stress Trajectory: {traj_id} — {meta['title']}"
+    for traj_id, meta in TRAJECTORY_REGISTRY.items()
+}
+TRAJ_402_BASE = {
+    traj_id: {
+        "status": 402,
+        "message": "Payment required",
+        "trajectory": {
+            "id": traj_id,
+            "title": meta["title"],
+            "price_sats": meta["price"],
+        },
+    }
+    for traj_id, meta in TRAJECTORY_REGISTRY.items()
+}
+
+
+@app.route("/", methods=["GET"])
+def index():
+    """Server info and API documentation."""
+    return Response(_INDEX_BYTES, mimetype="application/json")
+
+
+@app.route("/api/catalog", methods=["GET"])
+def catalog():
+    """
+    Free endpoint: returns the full skill catalog with metadata, pricing,
+    and routing info. This is what AI agents use to discover available skills.
+    """
+    return Response(_CATALOG_BYTES, mimetype="application/json")
 
 
 @app.route("/api/skills/<skill_id>/preview", methods=["GET"])
@@ -335,29 +893,18 @@ def skill_preview(skill_id):
     skill_id = skill_id.upper()
     
     if skill_id not in SKILL_REGISTRY:
-        return jsonify({"error": "Skill not found"}), 404
+        return ojsonify({"error": "Skill not found"}), 404
     
     meta = SKILL_REGISTRY[skill_id]
-    content = load_skill_content(skill_id)
+    preview = SKILL_PREVIEW.get(skill_id)
     
-    if not content:
-        return jsonify({"error": "Skill content unavailable"}), 500
-    
-    # Extract first section only (up to second ## heading)
-    lines = content.split("\n")
-    preview_lines = []
-    section_count = 0
-    for line in lines:
-        if line.startswith("## ") and section_count > 0:
-            break
-        if line.startswith("## "):
-            section_count += 1
-        preview_lines.append(line)
-    
-    preview = "\n".join(preview_lines)
-    preview += f"\n\n---\n*[Preview only. Full content: {meta['price']} sats via L402 at /api/skills/{skill_id}]*"
-    
-    return jsonify({
+    if preview is None:
+        content = load_skill_content(skill_id)
+        if not content:
+            return ojsonify({"error": "Skill content unavailable"}), 500
+        preview = SKILL_PREVIEW[skill_id] = _build_preview(skill_id, content)
+    
+    return ojsonify({
         "id": skill_id,
         "title": meta["title"],
         "type": meta["type"],
@@ -373,7 +920,7 @@ def get_skill(skill_id):
     """L402-gated skill endpoint with structured data support."""
     skill_id = skill_id.upper()
     if skill_id not in SKILL_REGISTRY:
-        return jsonify({"error": "Skill not found"}), 404
+        return ojsonify({"error": "Skill not found"}), 404
 
     meta = SKILL_REGISTRY[skill_id]
     output_format = request.args.get("format", "full").lower()
@@ -383,10 +930,10 @@ def get_skill(skill_id):
         result = verify_l402_auth(auth_header)
         if result["valid"]:
             if result["skill_id"] != skill_id:
-                return jsonify({"error": "Token not valid for this skill"}), 403
+                return ojsonify({"error": "Token not valid for this skill"}), 403
             content = load_skill_content(skill_id)
             if not content:
-                return jsonify({"error": "Content unavailable"}), 500
+                return ojsonify({"error": "Content unavailable"}), 500
 
             response_data = {
                 "id": skill_id,
@@ -399,46 +946,35 @@ def get_skill(skill_id):
             if output_format == "raw":
                 response_data["content"] = content
             elif output_format == "structured":
-                structured = parse_skill_content(content, skill_id)
+                structured = _parsed_skill(skill_id)
                 response_data["structured"] = structured
             else:
-                structured = parse_skill_content(content, skill_id)
                 response_data["content"] = content
-                response_data["structured"] = structured
-                response_data["routing"] = {
-                    "trigger_conditions": structured["trigger_conditions"],
-                    "prerequisites": structured["prerequisites"],
-                    "next_steps": structured["next_steps"],
-                    "contraindications": structured["contraindications"],
-                }
-            return jsonify(response_data)
+                response_data["structured"] = _parsed_skill(skill_id)
+                response_data["routing"] = _skill_routing(skill_id)
+            return ojsonify(response_data)
         else:
-            return jsonify({"error": result.get("error", "Invalid authorization")}), 401
+            return ojsonify({"error": result.get("error", "Invalid authorization")}), 401
 
     invoice = create_invoice(
         amount_sats=meta["price"],
-        memo="Overcome Stress Skill: " + skill_id + " - " + meta["title"]
+        memo=SKILL_MEMO[skill_id]
     )
     if not invoice:
-        return jsonify({"error": "Payment service unavailable"}), 503
+        return ojsonify({"error": "Payment service unavailable"}), 503
 
     macaroon = create_macaroon(invoice["payment_hash"], skill_id)
-    payment_store[invoice["payment_hash"]] = {
+    record_payment(invoice["payment_hash"], {
         "skill_id": skill_id, "paid": False,
         "created": time.time(), "amount": meta["price"],
-    }
-    save_payments()
+    })
 
-    resp_data = {
-        "status": 402, "message": "Payment required",
-        "skill": {"id": skill_id, "title": meta["title"], "price_sats": meta["price"], "type": meta["type"]},
+    resp_data = SKILL_402_BASE[skill_id] | {
         "invoice": {"payment_request": invoice["payment_request"], "payment_hash": invoice["payment_hash"], "amount_sats": invoice["amount"]},
         "macaroon": macaroon,
-        "instructions": "Pay the Lightning invoice, then retry with header: Authorization: L402 {macaroon}:{preimage}",
-        "formats_available": ["full", "structured", "raw"],
     }
 
-    response = Response(json.dumps(resp_data), status=402, mimetype="application/json")
+    response = ojsonify(resp_data, 402)
     response.headers["WWW-Authenticate"] = 'L402 macaroon="' + macaroon + '", invoice="' + invoice["payment_request"] + '"'
     return response
 
@@ -447,10 +983,12 @@ def get_skill(skill_id):
 def payment_status(payment_hash):
     """Check payment status for a given payment hash."""
     paid = check_invoice_paid(payment_hash)
+    if paid:
+        mark_paid(payment_hash)
     
     stored = payment_store.get(payment_hash, {})
     
-    return jsonify({
+    return ojsonify({
         "payment_hash": payment_hash,
         "paid": paid,
         "skill_id": stored.get("skill_id"),
@@ -464,7 +1002,7 @@ def get_trajectory(traj_id):
     traj_id = traj_id.upper()
     
     if traj_id not in TRAJECTORY_REGISTRY:
-        return jsonify({"error": "Trajectory not found"}), 404
+        return ojsonify({"error": "Trajectory not found"}), 404
     
     meta = TRAJECTORY_REGISTRY[traj_id]
     
@@ -475,48 +1013,36 @@ def get_trajectory(traj_id):
         result = verify_l402_auth(auth_header)
         if result["valid"] and result["skill_id"] == traj_id:
             # Serve trajectory content
-            return jsonify(get_trajectory_content(traj_id))
+            return ojsonify(get_trajectory_content(traj_id))
         elif auth_header:
-            return jsonify({"error": "Invalid authorization"}), 401
+            return ojsonify({"error": "Invalid authorization"}), 401
     
     # Create invoice
     invoice = create_invoice(
         amount_sats=meta["price"],
-        memo=f"Overcome Stress Trajectory: {traj_id} — {meta['title']}"
+        memo=TRAJ_MEMO[traj_id]
     )
     
     if not invoice:
-        return jsonify({"error": "Payment service unavailable"}), 503
+        return ojsonify({"error": "Payment service unavailable"}), 503
     
     macaroon = create_macaroon(invoice["payment_hash"], traj_id)
     
-    payment_store[invoice["payment_hash"]] = {
+    record_payment(invoice["payment_hash"], {
         "skill_id": traj_id,
         "paid": False,
         "created": time.time(),
         "amount": meta["price"],
-    }
-    save_payments()
-    
-    response = Response(
-        json.dumps({
-            "status": 402,
-            "message": "Payment required",
-            "trajectory": {
-                "id": traj_id,
-                "title": meta["title"],
-                "price_sats": meta["price"],
-            },
-            "invoice": {
-                "payment_request": invoice["payment_request"],
-                "payment_hash": invoice["payment_hash"],
-                "amount_sats": invoice["amount"],
-            },
-            "macaroon": macaroon,
-        }),
-        status=402,
-        mimetype="application/json"
-    )
+    })
+    
+    response = ojsonify(TRAJ_402_BASE[traj_id] | {
+        "invoice": {
+            "payment_request": invoice["payment_request"],
+            "payment_hash": invoice["payment_hash"],
+            "amount_sats": invoice["amount"],
+        },
+        "macaroon": macaroon,
+    }, 402)
     
     response.headers["WWW-Authenticate"] = (
         f'L402 macaroon="{macaroon}", '
@@ -528,7 +1054,7 @@ def get_trajectory(traj_id):
 
 def get_trajectory_content(traj_id: str) -> dict:
     """Return full trajectory content from markdown file (structured)."""
-    result = load_trajectory(traj_id)
+    result = TRAJ_BLOB.get(traj_id) or load_trajectory(traj_id)
     if result:
         return result
     # Fallback to basic info from registry
@@ -543,21 +1069,17 @@ def get_trajectory_content(traj_id: str) -> dict:
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint."""
-    return jsonify({"status": "ok", "timestamp": int(time.time())})
+    return ojsonify({"status": "ok", "timestamp": int(time.time())})
 
 
 @app.route("/api/stats", methods=["GET"])
 def stats():
-    """Public stats (no sensitive data)."""
-    cleanup_expired_payments()
-    total_paid = sum(1 for p in payment_store.values() if p.get("paid"))
-    total_sats = sum(p.get("amount", 0) for p in payment_store.values() if p.get("paid"))
-    
-    return jsonify({
+    """Public stats (no sensitive data). Counters are kept by the background sweep."""
+    return ojsonify({
         "total_skills": len(SKILL_REGISTRY),
         "total_trajectories": len(TRAJECTORY_REGISTRY),
-        "total_payments_24h": total_paid,
-        "total_sats_24h": total_sats,
+        "total_payments_24h": _stats["paid"],
+        "total_sats_24h": _stats["sats"],
     })
 
 
@@ -565,8 +1087,18 @@ def stats():
 # Main
 # =============================================================================
 
-if __name__ == "__main__":
+def init_server():
+    """
+    Load persisted payments, preload content and start the expiry sweep.
+    Called from __main__ or gunicorn's post_worker_init hook, never on import.
+    """
     load_payments()
+    _bg_sweep()
+    preload_content()
+
+if __name__ == "__main__":
+    init_server()
+    signal.signal(signal.SIGHUP, _reload_on_sighup)
     print(f"""
 ╔══════════════════════════════════════════════════════╗
 ║  Overcome Stress — L402 Skill Server                ║
@@ -576,4 +1108,4 @@ if __name__ == "__main__":
 ║  Protocol: L402 (HTTP 402 + Lightning Network)      ║
 ╚══════════════════════════════════════════════════════╝
     """)
-    app.run(host="0.0.0.0", port=PORT, debug=False)
+    app.run(host="0.0.0.0", port=PORT, debug=False, threaded=True)